@@ -4,8 +4,13 @@ __author__ = 'orlando'
 
 import codecs
 import datetime
+import json
 import re
 import pprint
+import tempfile
+import time
+import src.lib.data as data
+import src.lib.rules as rules
 import src.lib.utils as utils
 import xml.etree.cElementTree as ET
 
@@ -98,6 +103,38 @@ CUSTOM_TAG_VALUES_MAPPING = {
 
 }
 
+# Rules that ship with the project. Extra rule files are compiled on top
+# of these, see src/lib/rules.py for their format.
+DEFAULT_RULES = {
+    "id_tag_delete": ID_TO_TAG_DELETE_MAPPING,
+    "custom_tag_values": CUSTOM_TAG_VALUES_MAPPING,
+    "key_renames": ATTRIBUTES_CLEAN_KEY_MAPPING
+}
+
+# Address tags inferred from the boundaries that contain a node. Postal code
+# boundaries carry their value in the "postal_code" tag, while administrative
+# boundaries carry it in "name" and are told apart by their admin_level.
+# In Venezuela admin_level 6 is the municipality, which isn't written to the
+# nodes and only sets addr:city when it is listed in MUNICIPALITY_CITY_MAPPING.
+POSTAL_CODE_BOUNDARY_TAG = "postal_code"
+ADMIN_LEVEL_TAG_MAPPING = {
+    "4": "addr:state"
+}
+MUNICIPALITY_ADMIN_LEVEL = "6"
+
+MUNICIPALITY_CITY_MAPPING = {
+    "Libertador": "Caracas",
+    "Municipio Libertador": "Caracas",
+    "Chacao": "Caracas",
+    "Municipio Chacao": "Caracas",
+    "Baruta": "Caracas",
+    "Municipio Baruta": "Caracas",
+    "Sucre": "Caracas",
+    "Municipio Sucre": "Caracas",
+    "El Hatillo": "Caracas",
+    "Municipio El Hatillo": "Caracas"
+}
+
 """FUNCTIONS"""
 
 # Utilities
@@ -116,6 +153,44 @@ def print_elements_with_tag_value(osm_file, tag_value):
         utils.pretty_element(element)
 
 
+def benchmark_json_dump(osm_file=ORIGINAL_OSM_MAP_FILE, repeat=3):
+    # Compare json.dump against data.dump_elements on the shaped elements of
+    # a map, keeping the best of a few runs for each serializer
+    elements = []
+    for _, element in ET.iterparse(osm_file):
+        el = data.shape_element(element)
+        if el:
+            elements.append(el)
+
+    serializers = {
+        "json.dump": lambda json_f, pretty: json.dump(
+            elements, json_f, indent=data.JSON_PRETTY_INDENT if pretty
+            else None),
+        "dump_elements": lambda json_f, pretty: data.dump_elements(
+            elements, json_f, pretty),
+    }
+    if data.fast_json is not None:
+        serializers["dump_elements+" + data.fast_json.__name__] = \
+            lambda json_f, pretty: data.dump_elements(
+                elements, json_f, pretty, backend=data.fast_json)
+
+    timings = {}
+    for name, serialize in serializers.iteritems():
+        for pretty in (False, True):
+            best = None
+            for _ in xrange(repeat):
+                with tempfile.TemporaryFile('w+b', data.JSON_BUFFER_SIZE) \
+                        as json_f:
+                    start = time.time()
+                    serialize(json_f, pretty)
+                    json_f.flush()
+                    elapsed = time.time() - start
+                if best is None or elapsed < best:
+                    best = elapsed
+            timings[(name, "pretty" if pretty else "compact")] = best
+    return timings
+
+
 # Auditing
 
 def audit_street_type(audit_dict, street_name):
@@ -232,63 +307,191 @@ def clean_city_value(city_value):
     return city_value
 
 
-def clean_element(element, clean_summary):
+def is_addressed_node(element):
+    if element.tag != "node":
+        return False
+    for tag in element.iter("tag"):
+        if tag.attrib['k'].startswith("addr:"):
+            return True
+    return False
+
+
+def boundary_address_tags(boundary):
+    tags = boundary["tags"]
+    if tags["boundary"] == "postal_code":
+        if POSTAL_CODE_BOUNDARY_TAG in tags:
+            return {"addr:postcode": tags[POSTAL_CODE_BOUNDARY_TAG]}
+    elif tags["boundary"] == "administrative" and "name" in tags:
+        admin_level = tags.get("admin_level")
+        if admin_level in ADMIN_LEVEL_TAG_MAPPING:
+            return {ADMIN_LEVEL_TAG_MAPPING[admin_level]: tags["name"]}
+        if (admin_level == MUNICIPALITY_ADMIN_LEVEL and
+                tags["name"] in MUNICIPALITY_CITY_MAPPING):
+            return {"addr:city": MUNICIPALITY_CITY_MAPPING[tags["name"]]}
+    return {}
+
+
+def infer_address_tags(osm_file):
+    # Build the boundary polygons and label every addressed node in one go.
+    # Boundaries come from the largest to the smallest, so the most specific
+    # one wins when several of them set the same tag on a node. The geo module
+    # is imported here since it needs numpy, which the rest of the session
+    # doesn't.
+    import src.lib.geo as geo
+
+    boundaries, node_ids, lons, lats = geo.load_geometry(
+        osm_file, is_addressed_node)
+    inferred_tags = defaultdict(dict)
+    for boundary, indexes in geo.locate_points(lons, lats, boundaries):
+        address_tags = boundary_address_tags(boundary)
+        if not address_tags:
+            continue
+        for idx in indexes:
+            inferred_tags[node_ids[idx]].update(address_tags)
+    return inferred_tags
+
+
+def apply_inferred_tags(element, inferred_tags, child_tags_map,
+                        child_tags_to_delete, clean_summary):
+    # Inferred values fill in missing tags and replace malformed postcodes.
+    # Well formed values that disagree are only reported, since they might
+    # come from a fix in CUSTOM_TAG_VALUES_MAPPING. Inferred postcodes are
+    # validated too, since they come from boundary tags that might be wrong.
+    for tag_key, inferred_value in inferred_tags.iteritems():
+        if tag_key in child_tags_to_delete:
+            continue
+        if (tag_key == "addr:postcode" and
+                not POST_CODE_REGEX.search(inferred_value)):
+            summary_key = u"<{}={}>".format(tag_key, inferred_value)
+            clean_summary['rejected_tag_values'][summary_key] += 1
+            continue
+        if tag_key not in child_tags_map:
+            ET.SubElement(element, "tag", {'k': tag_key, 'v': inferred_value})
+            summary_key = u"<{}={}>".format(tag_key, inferred_value)
+            clean_summary['inferred_tag_values'][summary_key] += 1
+            continue
+        tag = child_tags_map[tag_key]
+        tag_value = tag.attrib['v']
+        if tag_value == inferred_value:
+            continue
+        if (tag_key == "addr:postcode" and
+                not POST_CODE_REGEX.search(tag_value)):
+            tag.attrib['v'] = inferred_value
+            summary_key = u"<{}={},{}>".format(
+                tag_key, tag_value, inferred_value)
+            clean_summary['inferred_tag_values'][summary_key] += 1
+        else:
+            summary_key = u"<{}={},{}>".format(
+                tag_key, tag_value, inferred_value)
+            clean_summary['mismatched_tag_values'][summary_key] += 1
+
+
+# Value cleaners dispatched by tag key, along with the clean summary key
+# where their updates are recorded
+TAG_VALUE_CLEANERS = {
+    "addr:street": (clean_street_name, 'updated_street_types'),
+    "addr:city": (clean_city_value, 'updated_city_types')
+}
+
+
+def clean_element(element, clean_summary, compiled_rules, inferred_tags=None):
+    element_id = element.attrib['id']
+
     # Create a map for child tags to make it easier cross reference tags
     child_tags_map = {}
     for tag in element.iter("tag"):
         child_tags_map[tag.attrib['k']] = tag
 
     # Extract map with child tags to delete
-    child_tags_to_delete = []
-    if element.attrib['id'] in ID_TO_TAG_DELETE_MAPPING:
-        child_tags_to_delete = ID_TO_TAG_DELETE_MAPPING[element.attrib['id']]
+    child_tags_to_delete = compiled_rules["deletes"].get(element_id, {})
 
     # Clean up child tags
+    triggers = compiled_rules["triggers"]
+    renames = compiled_rules["renames"]
+    deleted_keys = []
+    renamed_keys = []
     for tag_key, tag in child_tags_map.iteritems():
         tag_value = tag.attrib['v']
         if tag_key in child_tags_to_delete:
             element.remove(tag)
+            deleted_keys.append(tag_key)
             summary_key = tag_key + "=" + tag_value
             clean_summary['deleted_tag_types'][summary_key] = 1
+            clean_summary['rule_hits'][child_tags_to_delete[tag_key]] += 1
+            continue
+        if tag_key in triggers:
+            # We allow the assignment of a custom value to a set of tags
+            # if we match a substring of another tag value. For example, we
+            # might want to force a postal code based on the address value.
+            automaton, tag_rules = triggers[tag_key]
+            matches = rules.search_automaton(
+                automaton, rules.to_unicode(tag_value))
+            if matches:
+                map_dict, rule_label = tag_rules[min(matches)]
+                clean_summary['rule_hits'][rule_label] += 1
+                for ref_key, custom_value in map_dict.iteritems():
+                    if ref_key in child_tags_map:
+                        ref_value = child_tags_map[ref_key].attrib['v']
+                        if ref_value != custom_value:
+                            child_tags_map[ref_key].attrib[
+                                'v'] = custom_value
+                            summary_key = u"<{}={},{}={}>".format(
+                                tag_key, tag_value, ref_key, custom_value)
+                            clean_summary['custom_tag_values'][
+                                summary_key] += 1
+        if tag_key in TAG_VALUE_CLEANERS:
+            clean_function, summary_field = TAG_VALUE_CLEANERS[tag_key]
+            clean_value = clean_function(tag_value)
+            if clean_value != tag_value:
+                tag.attrib['v'] = clean_value
+                clean_summary[summary_field][tag_value] = clean_value
+        if tag_key in renames:
+            new_key, rule_label = renames[tag_key]
+            tag.attrib['k'] = new_key
+            renamed_keys.append((tag_key, new_key))
+            clean_summary['updated_attribute_types'][tag_key] += 1
+            clean_summary['rule_hits'][rule_label] += 1
+
+    # Keep the map in sync with the element, so later steps see the tags
+    # under their final keys
+    for tag_key in deleted_keys:
+        del child_tags_map[tag_key]
+    for tag_key, new_key in renamed_keys:
+        child_tags_map[new_key] = child_tags_map.pop(tag_key)
+
+    # Force the values of tags overridden for this specific element
+    for tag_key, (tag_value, rule_label) in compiled_rules["overrides"].get(
+            element_id, {}).iteritems():
+        if tag_key not in child_tags_map:
+            child_tags_map[tag_key] = ET.SubElement(
+                element, "tag", {'k': tag_key, 'v': tag_value})
+        elif child_tags_map[tag_key].attrib['v'] != tag_value:
+            child_tags_map[tag_key].attrib['v'] = tag_value
         else:
-            if tag_key in CUSTOM_TAG_VALUES_MAPPING:
-                # We allow the assignment of a custom value to a set of tags
-                # if we match a substring of another tag value. For example, we
-                # might want to force a postal code based on the address value.
-                tag_mapping = CUSTOM_TAG_VALUES_MAPPING[tag_key]
-                for sub_str, map_dict in tag_mapping.iteritems():
-                    if sub_str in tag_value.encode('utf-8'):
-                        for ref_key, custom_value in map_dict.iteritems():
-                            if ref_key in child_tags_map:
-                                ref_value = child_tags_map[ref_key].attrib['v']
-                                if ref_value != custom_value:
-                                    child_tags_map[ref_key].attrib[
-                                        'v'] = custom_value
-                                    summary_key = u"<{}={},{}={}>".format(
-                                        tag_key, tag_value, ref_key,
-                                        custom_value)
-                                    clean_summary['custom_tag_values'][
-                                        summary_key] += 1
-                        break
-            if tag_key == "addr:street":
-                clean_value = clean_street_name(tag_value)
-                if clean_value != tag_value:
-                    tag.attrib['v'] = clean_value
-                    clean_summary['updated_street_types'][
-                        tag_value] = clean_value
-            if tag_key == "addr:city":
-                clean_value = clean_city_value(tag_value)
-                if clean_value != tag_value:
-                    tag.attrib['v'] = clean_value
-                    clean_summary['updated_city_types'][
-                        tag_value] = clean_value
-            if tag_key in ATTRIBUTES_CLEAN_KEY_MAPPING:
-                tag.attrib['k'] = ATTRIBUTES_CLEAN_KEY_MAPPING[tag_key]
-                clean_summary['updated_attribute_types'][tag_key] += 1
+            continue
+        clean_summary['rule_hits'][rule_label] += 1
+
+    # Fill in or validate address tags inferred from the map boundaries. Only
+    # nodes are labeled, and their ids may clash with the ids of ways.
+    if (inferred_tags and element.tag == "node" and
+            element_id in inferred_tags):
+        apply_inferred_tags(element, inferred_tags[element_id],
+                            child_tags_map, child_tags_to_delete,
+                            clean_summary)
 
 
 def clean_up_map(original_osm=ORIGINAL_OSM_MAP_FILE,
-                 clean_osm=CLEAN_OSM_MAP_FILE):
+                 clean_osm=CLEAN_OSM_MAP_FILE, infer_addresses=True,
+                 rule_files=()):
+    # Compile the cleaning rules once for the whole map
+    compiled_rules = rules.compile_rules(
+        [DEFAULT_RULES] + [rules.load_rule_file(path) for path in rule_files])
+
+    # Label addressed nodes with the boundaries that contain them
+    inferred_tags = None
+    if infer_addresses:
+        inferred_tags = infer_address_tags(original_osm)
+
     # Get an iterable
     context = ET.iterparse(original_osm, events=("start", "end"))
 
@@ -305,10 +508,15 @@ def clean_up_map(original_osm=ORIGINAL_OSM_MAP_FILE,
         "updated_attribute_types": defaultdict(int),
         "deleted_tag_types": defaultdict(int),
         "custom_tag_values": defaultdict(int),
+        "inferred_tag_values": defaultdict(int),
+        "mismatched_tag_values": defaultdict(int),
+        "rejected_tag_values": defaultdict(int),
+        "rule_hits": defaultdict(int),
     }
     for event, element in context:
         if event == "end" and (element.tag == "node" or element.tag == "way"):
-            clean_element(element, clean_summary)
+            clean_element(element, clean_summary, compiled_rules,
+                          inferred_tags)
 
     # Save
     tree = ET.ElementTree(root)
@@ -318,8 +526,9 @@ def clean_up_map(original_osm=ORIGINAL_OSM_MAP_FILE,
 
 
 def generate_clean_summary(save_path, original_osm=ORIGINAL_OSM_MAP_FILE,
-                           clean_osm=CLEAN_OSM_MAP_FILE):
-    clean_summary = clean_up_map(original_osm, clean_osm)
+                           clean_osm=CLEAN_OSM_MAP_FILE, rule_files=()):
+    clean_summary = clean_up_map(original_osm, clean_osm,
+                                 rule_files=rule_files)
     with codecs.open(save_path, mode='w', encoding='utf-8') as file_o:
         for key, value in clean_summary.iteritems():
             file_o.write('{}: {}\n'.format(key, len(value)))
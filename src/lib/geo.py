@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__author__ = 'orlando'
+
+import numpy as np
+import xml.etree.cElementTree as ET
+
+from collections import defaultdict
+
+"""GLOBALS"""
+
+# Relation types whose members are assembled into boundary polygons
+BOUNDARY_RELATION_TYPES = ["boundary", "multipolygon"]
+
+# Size in degrees of the cells used to bucket points before the
+# point-in-polygon tests (0.01 degrees is roughly 1 km around Caracas)
+GRID_CELL_SIZE = 0.01
+
+"""Functions"""
+
+
+def assemble_rings(ways):
+    """ Joins a list of ways, each one given as a list of node ids, into
+    closed rings by matching their end points. Ways that can't be closed
+    are dropped.
+
+    :param ways: List of lists with node ids
+    :return: List of closed rings as lists of node ids
+    """
+    rings = []
+    pending = [list(way) for way in ways if len(way) > 1]
+    while pending:
+        ring = pending.pop()
+        while ring[0] != ring[-1]:
+            for idx, way in enumerate(pending):
+                if way[0] == ring[-1]:
+                    ring.extend(way[1:])
+                elif way[-1] == ring[-1]:
+                    ring.extend(reversed(way[:-1]))
+                else:
+                    continue
+                del pending[idx]
+                break
+            else:
+                # No way continues this ring, so it can't be closed
+                break
+        else:
+            if len(ring) > 3:
+                rings.append(ring)
+    return rings
+
+
+def ring_area(ring):
+    """ Returns the unsigned area of a ring using the shoelace formula
+
+    :param ring: Numpy array of shape (n, 2) with lon/lat coordinates
+    :return: Float area in square degrees
+    """
+    x = ring[:, 0]
+    y = ring[:, 1]
+    return abs(np.dot(x, np.roll(y, -1)) - np.dot(y, np.roll(x, -1))) / 2.0
+
+
+def points_in_ring(lons, lats, ring):
+    """ Vectorized even-odd point-in-polygon test of many points against a
+    single ring. The loop runs over the edges of the ring while every edge
+    is tested against all the points at once.
+
+    :param lons: Numpy array with point longitudes
+    :param lats: Numpy array with point latitudes
+    :param ring: Numpy array of shape (n, 2) with lon/lat coordinates
+    :return: Numpy boolean array, True for points inside the ring
+    """
+    inside = np.zeros(len(lons), dtype=bool)
+    x1 = ring[:-1, 0]
+    y1 = ring[:-1, 1]
+    x2 = ring[1:, 0]
+    y2 = ring[1:, 1]
+    for idx in xrange(len(x1)):
+        crosses = (y1[idx] > lats) != (y2[idx] > lats)
+        if not crosses.any():
+            continue
+        # Horizontal edges never satisfy crosses, so the division is safe
+        slope = (x2[idx] - x1[idx]) / (y2[idx] - y1[idx])
+        x_cross = x1[idx] + (lats[crosses] - y1[idx]) * slope
+        inside[crosses] ^= lons[crosses] < x_cross
+    return inside
+
+
+def load_geometry(osm_file, point_filter):
+    """ Parses a provided OSM XML file once and builds both the boundary
+    polygons and the coordinates of the nodes accepted by point_filter.
+
+    Boundaries come from closed ways with a "boundary" tag and from
+    relations of a type in BOUNDARY_RELATION_TYPES with a "boundary" tag.
+    Every boundary is a dictionary like:
+
+    {
+        "id": "11219",
+        "tags": {"boundary": "administrative", "admin_level": "4", ...},
+        "rings": [array([[lon, lat], ...]), ...],
+        "bbox": (min_lon, min_lat, max_lon, max_lat),
+        "area": 0.0213
+    }
+
+    Relation members with the "inner" role are holes and every other way
+    member is part of the outer rings. Both kinds of rings are kept
+    together since the even-odd rule takes care of the holes, while the
+    area is the one of the outer rings minus the holes.
+
+    :param osm_file: File path to OSM XML file
+    :param point_filter: Function receiving a node element that returns
+                         True for the nodes whose coordinates are desired
+    :return: Tuple with (boundaries, point_ids, lons, lats)
+    """
+    coords = {}
+    way_refs = {}
+    boundary_members = []
+    point_ids = []
+    point_lons = []
+    point_lats = []
+    context = ET.iterparse(osm_file, events=('start', 'end'))
+    _, root = next(context)
+    for event, element in context:
+        if event != 'end' or element.tag not in ('node', 'way', 'relation'):
+            continue
+        tags = dict((tag.attrib['k'], tag.attrib['v'])
+                    for tag in element.iter('tag'))
+        if element.tag == 'node':
+            lon = float(element.attrib['lon'])
+            lat = float(element.attrib['lat'])
+            coords[element.attrib['id']] = (lon, lat)
+            if point_filter(element):
+                point_ids.append(element.attrib['id'])
+                point_lons.append(lon)
+                point_lats.append(lat)
+        elif element.tag == 'way':
+            refs = [nd.attrib['ref'] for nd in element.iter('nd')]
+            way_refs[element.attrib['id']] = refs
+            if 'boundary' in tags:
+                boundary_members.append(
+                    (element.attrib['id'], tags, [refs], []))
+        elif ('boundary' in tags and
+              tags.get('type') in BOUNDARY_RELATION_TYPES):
+            outer_ways = []
+            inner_ways = []
+            for member in element.iter('member'):
+                if (member.attrib['type'] != 'way' or
+                        member.attrib['ref'] not in way_refs):
+                    continue
+                if member.attrib.get('role') == 'inner':
+                    inner_ways.append(way_refs[member.attrib['ref']])
+                else:
+                    outer_ways.append(way_refs[member.attrib['ref']])
+            boundary_members.append(
+                (element.attrib['id'], tags, outer_ways, inner_ways))
+        root.clear()
+
+    boundaries = []
+    for element_id, tags, outer_ways, inner_ways in boundary_members:
+        outer_rings = [np.array([coords[ref] for ref in ring])
+                       for ring in assemble_rings(outer_ways)
+                       if all(ref in coords for ref in ring)]
+        if not outer_rings:
+            continue
+        inner_rings = [np.array([coords[ref] for ref in ring])
+                       for ring in assemble_rings(inner_ways)
+                       if all(ref in coords for ref in ring)]
+        rings = outer_rings + inner_rings
+        stacked = np.vstack(outer_rings)
+        boundaries.append({
+            "id": element_id,
+            "tags": tags,
+            "rings": rings,
+            "bbox": tuple(stacked.min(axis=0)) + tuple(stacked.max(axis=0)),
+            "area": (sum(ring_area(ring) for ring in outer_rings) -
+                     sum(ring_area(ring) for ring in inner_rings))
+        })
+    return (boundaries, point_ids, np.array(point_lons),
+            np.array(point_lats))
+
+
+def build_grid(lons, lats, cell_size=GRID_CELL_SIZE):
+    """ Buckets points into a regular grid of square cells
+
+    :param lons: Numpy array with point longitudes
+    :param lats: Numpy array with point latitudes
+    :param cell_size: Size in degrees of each cell
+    :return: Dict mapping (col, row) cells to numpy arrays of point indexes
+    """
+    cols = np.floor(lons / cell_size).astype(int)
+    rows = np.floor(lats / cell_size).astype(int)
+    grid = defaultdict(list)
+    for idx, cell in enumerate(zip(cols, rows)):
+        grid[cell].append(idx)
+    return dict((cell, np.array(indexes))
+                for cell, indexes in grid.iteritems())
+
+
+def locate_points(lons, lats, boundaries, cell_size=GRID_CELL_SIZE):
+    """ Finds which points fall inside each boundary. Boundaries are
+    yielded from the largest to the smallest area, so callers that keep
+    the last match per point end up with the most specific boundary.
+
+    :param lons: Numpy array with point longitudes
+    :param lats: Numpy array with point latitudes
+    :param boundaries: List of boundaries as returned by load_geometry
+    :param cell_size: Size in degrees of the grid cells
+    :return: Generator of (boundary, numpy array of point indexes) tuples
+    """
+    grid = build_grid(lons, lats, cell_size)
+    for boundary in sorted(boundaries, key=lambda b: b["area"],
+                           reverse=True):
+        min_lon, min_lat, max_lon, max_lat = boundary["bbox"]
+        candidates = [grid[(col, row)]
+                      for col in xrange(int(np.floor(min_lon / cell_size)),
+                                        int(np.floor(max_lon / cell_size)) + 1)
+                      for row in xrange(int(np.floor(min_lat / cell_size)),
+                                        int(np.floor(max_lat / cell_size)) + 1)
+                      if (col, row) in grid]
+        if not candidates:
+            continue
+        candidates = np.concatenate(candidates)
+        inside = np.zeros(len(candidates), dtype=bool)
+        for ring in boundary["rings"]:
+            inside ^= points_in_ring(lons[candidates], lats[candidates], ring)
+        if inside.any():
+            yield boundary, candidates[inside]
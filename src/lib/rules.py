@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__author__ = 'orlando'
+
+import json
+
+"""GLOBALS"""
+
+# Sections a rule set may define. For example:
+#
+# {
+#     "id_tag_delete": {"914310439": ["addr:postcode"]},
+#     "id_tag_override": {"2406124091": {"addr:postcode": "1060"}},
+#     "custom_tag_values": {
+#         "addr:street": {"Los Chaguaramos": {"addr:postcode": "1060"}}
+#     },
+#     "key_renames": {"addr:ful": "addr:full"}
+# }
+RULE_SECTIONS = ["id_tag_delete", "id_tag_override", "custom_tag_values",
+                 "key_renames"]
+
+"""Functions"""
+
+
+def to_unicode(value):
+    """ Decodes UTF-8 byte strings, leaving unicode strings untouched
+
+    :param value: String or unicode value
+    :return: Unicode value
+    """
+    if isinstance(value, str):
+        return value.decode('utf-8')
+    return value
+
+
+def build_automaton(patterns):
+    """ Builds an Aho-Corasick automaton that finds all the provided
+    patterns in a single scan of a text. The automaton is a dictionary:
+
+    {
+        "goto": [{char: state, ...}, ...],
+        "fail": [state, ...],
+        "output": [[pattern index, ...], ...]
+    }
+
+    :param patterns: List of unicode patterns
+    :return: Dict with the automaton tables
+    """
+    goto = [{}]
+    output = [[]]
+    for pattern_idx, pattern in enumerate(patterns):
+        state = 0
+        for char in pattern:
+            if char not in goto[state]:
+                goto.append({})
+                output.append([])
+                goto[state][char] = len(goto) - 1
+            state = goto[state][char]
+        output[state].append(pattern_idx)
+
+    # Breadth first pass to link every state to its longest proper suffix
+    fail = [0] * len(goto)
+    queue = list(goto[0].values())
+    for state in queue:
+        for char, next_state in goto[state].iteritems():
+            queue.append(next_state)
+            suffix = fail[state]
+            while suffix and char not in goto[suffix]:
+                suffix = fail[suffix]
+            fail[next_state] = goto[suffix].get(char, 0)
+            output[next_state] = output[next_state] + output[
+                fail[next_state]]
+    return {"goto": goto, "fail": fail, "output": output}
+
+
+def search_automaton(automaton, text):
+    """ Scans a text with an automaton built by build_automaton
+
+    :param automaton: Dict with the automaton tables
+    :param text: Unicode text to scan
+    :return: Set with the indexes of the patterns found in text
+    """
+    goto = automaton["goto"]
+    fail = automaton["fail"]
+    output = automaton["output"]
+    found = set()
+    state = 0
+    for char in text:
+        while state and char not in goto[state]:
+            state = fail[state]
+        state = goto[state].get(char, 0)
+        found.update(output[state])
+    return found
+
+
+def load_rule_file(rule_file):
+    """ Loads a rule set from a JSON file with any of the RULE_SECTIONS
+
+    :param rule_file: File path to JSON rule file
+    :return: Dict with the rule set
+    """
+    with open(rule_file, 'r') as rule_f:
+        rule_set = json.load(rule_f)
+    unknown = set(rule_set) - set(RULE_SECTIONS)
+    if unknown:
+        raise ValueError('Unknown rule sections in {}: {}'.format(
+            rule_file, ', '.join(sorted(unknown))))
+    return rule_set
+
+
+def compile_rules(rule_sets):
+    """ Compiles a list of rule sets into indexed tables, so the cost of
+    cleaning an element doesn't grow with the number of rules. Later rule
+    sets take precedence over earlier ones, also across sections: a later
+    override of a tag drops an earlier delete of it and the other way
+    around. Within a single rule set, overrides win over deletes. The
+    result looks like:
+
+    {
+        "deletes": {element id: {tag key: rule label, ...}, ...},
+        "overrides": {element id: {tag key: (value, rule label), ...}, ...},
+        "triggers": {tag key: (automaton, [(value map, rule label), ...])},
+        "renames": {tag key: (new tag key, rule label), ...}
+    }
+
+    Rule labels are unicode strings used to count rule hits. When several
+    trigger patterns match the same value, only the one that sorts first
+    applies.
+
+    :param rule_sets: List of dicts with any of the RULE_SECTIONS
+    :return: Dict with the compiled rule tables
+    """
+    deletes = {}
+    overrides = {}
+    patterns = {}
+    renames = {}
+    for rule_set in rule_sets:
+        for element_id, tag_keys in rule_set.get(
+                "id_tag_delete", {}).iteritems():
+            element_id = to_unicode(element_id)
+            element_deletes = deletes.setdefault(element_id, {})
+            for tag_key in tag_keys:
+                tag_key = to_unicode(tag_key)
+                element_deletes[tag_key] = u"delete:{}:{}".format(
+                    element_id, tag_key)
+                overrides.get(element_id, {}).pop(tag_key, None)
+        for element_id, tag_values in rule_set.get(
+                "id_tag_override", {}).iteritems():
+            element_id = to_unicode(element_id)
+            element_overrides = overrides.setdefault(element_id, {})
+            for tag_key, tag_value in tag_values.iteritems():
+                tag_key = to_unicode(tag_key)
+                element_overrides[tag_key] = (
+                    to_unicode(tag_value),
+                    u"override:{}:{}".format(element_id, tag_key))
+                deletes.get(element_id, {}).pop(tag_key, None)
+        for tag_key, sub_str_mapping in rule_set.get(
+                "custom_tag_values", {}).iteritems():
+            key_patterns = patterns.setdefault(to_unicode(tag_key), {})
+            for sub_str, map_dict in sub_str_mapping.iteritems():
+                key_patterns[to_unicode(sub_str)] = dict(
+                    (to_unicode(ref_key), to_unicode(custom_value))
+                    for ref_key, custom_value in map_dict.iteritems())
+        for tag_key, new_key in rule_set.get("key_renames", {}).iteritems():
+            renames[to_unicode(tag_key)] = (
+                to_unicode(new_key), u"rename:{}".format(to_unicode(tag_key)))
+
+    triggers = {}
+    for tag_key, key_patterns in patterns.iteritems():
+        sub_strs = sorted(key_patterns)
+        triggers[tag_key] = (
+            build_automaton(sub_strs),
+            [(key_patterns[sub_str], u"trigger:{}:{}".format(tag_key, sub_str))
+             for sub_str in sub_strs])
+    return {
+        "deletes": deletes,
+        "overrides": overrides,
+        "triggers": triggers,
+        "renames": renames
+    }